@@ -2,57 +2,195 @@
 
 import argparse
 import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from datetime import datetime
 from pathlib import Path
-from pprint import pprint
+from pprint import pformat
 
-import dateutil.parser
 import googleapiclient.discovery
 import googleapiclient.errors
 import yt_dlp
 
-debug = False
+logger = logging.getLogger(__name__)
 
 scopes = ["https://www.googleapis.com/auth/youtube.force-ssl"]
 api_service_name = "youtube"
 api_version = "v3"
 
-youtube = googleapiclient.discovery.build(api_service_name, api_version, developerKey=Path('API_key').read_text())
+video_link_prefix = 'https://www.youtube.com/watch?v='
 
+ydl_opts = {
+    'paths': {'home': './downloads/'},
+    'format': 'm4a/bestaudio/best',
+    'outtmpl': '%(title)s - %(channel)s.%(ext)s'
+    # 'postprocessors': [{  # Extract audio using ffmpeg
+    #     'key': 'FFmpegExtractAudio',
+    #     'preferredcodec': 'm4a',
+    # }]
+}
 
-def main(arg_debug=False):
-    global debug
-    debug = arg_debug
+
+def create_youtube_client(api_key):
+    """
+    Builds the YouTube API client from the discovery document bundled with google-api-python-client, so no request
+    is made to fetch it.
+    """
+    return googleapiclient.discovery.build(
+        api_service_name,
+        api_version,
+        developerKey=api_key,
+        cache_discovery=False,
+        static_discovery=True
+    )
+
+
+def main(arg_debug=False, jobs=4):
+    logging.basicConfig()
+    logger.setLevel(logging.DEBUG if arg_debug else logging.INFO)
     videos = []
-    data = Path('last_downloaded')
 
-    with open('channel_ids') as f:
-        channel_ids = f.read().splitlines()
+    data = read_dict()
+    if data is None:
+        logger.debug('Datafile does not exist')
+        # one channel id per line, blank lines and lines starting with '#' are skipped.
+        channel_ids = []
+        with open('channel_ids') as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    channel_ids.append(line)
+        if channel_ids:
+            init_dict(create_youtube_client(Path('API_key').read_text()), channel_ids)
+        return
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Read from the datafile: %s', pformat(data))
 
-    if not data.exists():
-        debug_print('Datafile does not exist')
-        init_dict(channel_ids)
+    # nothing to check, skip building the client and the API calls.
+    if not data:
         return
 
-    data = read_dict()
-    debug_print(f'Read from the datafile: {data}')
+    youtube = create_youtube_client(Path('API_key').read_text())
+
+    # the datafile is only rewritten if something in it changed, in most runs nothing does.
+    changed = False
 
-    for channel in data:
-        result = get_video_list(channel['channel_id'], channel['video_id'])
+    unresolved = [channel for channel in data if 'playlist_id' not in channel]
+    if unresolved:
+        playlists = get_uploads_playlists(youtube, [channel['channel_id'] for channel in unresolved])
+        for channel in unresolved:
+            if channel['channel_id'] in playlists:
+                channel['playlist_id'] = playlists[channel['channel_id']]
+                changed = True
+            else:
+                logger.error('Failed to find channel %s, it is not checked for new videos', channel['channel_id'])
+
+    channels = [channel for channel in data if 'playlist_id' in channel]
+    requests = [list_videos_request(youtube, channel['playlist_id'], 50) for channel in channels]
+    responses = execute_batch(youtube, [channel['channel_id'] for channel in channels], requests)
+    for channel, response in zip(channels, responses):
+        if response is None:
+            continue
+        result = get_video_list(response, channel['channel_id'], channel['video_id'])
         videos += result[0]
         latest = result[1]
-        channel['video_id'] = latest
+        if latest != channel['video_id']:
+            channel['video_id'] = latest
+            changed = True
 
-    for video in videos:
-        download_audio(video['id'])
+    if videos:
+        download_videos([video['id'] for video in videos], jobs)
+
+    if changed:
+        write_dict(data)
 
-    write_dict(data)
 
+def get_uploads_playlists(youtube, channel_ids):
+    """
+    Returns the ids of the uploads playlists of YouTube channels.
+    Listing a playlist costs 1 quota unit, while searching a channel for its latest videos costs 100.
+    Args:
+        youtube: the YouTube API client.
+        channel_ids: the channel ids of the channels to look up, 50 of them are looked up per request.
+
+    Returns:
+        A dict of channel ids to uploads playlist ids, channels that were not found are left out.
 
-def get_video_list(channel_id, last_downloaded=None):
+    """
+    playlists = {}
+    for i in range(0, len(channel_ids), 50):
+        response = youtube.channels().list(
+            part="contentDetails",
+            id=','.join(channel_ids[i:i + 50]),
+            maxResults=50
+        ).execute()
+        for channel in response.get('items', []):
+            playlists[channel['id']] = channel['contentDetails']['relatedPlaylists']['uploads']
+    return playlists
+
+
+def list_videos_request(youtube, playlist_id, max_results):
+    """
+    Builds the API request for the latest videos of a channel's uploads playlist, newest first.
+    """
+    return youtube.playlistItems().list(
+        part="snippet",
+        playlistId=playlist_id,
+        maxResults=max_results
+    )
+
+
+def execute_batch(youtube, channel_ids, requests):
+    """
+    Executes API requests together in batched HTTP requests of up to 50 calls, so the fetch takes one round-trip per
+    50 channels instead of one per channel.
+    A request that fails in a batch, or every request if the batch itself fails, is retried on its own.
+    Args:
+        youtube: the YouTube API client.
+        channel_ids: the channel id each request is for, used in the error messages.
+        requests: a list of API requests.
+
+    Returns:
+        A list of responses in the same order as the requests, None for the requests that failed.
+
+    """
+    responses = [None] * len(requests)
+
+    def callback(request_id, response, exception):
+        if exception is not None:
+            logger.debug('Batched request for channel %s failed: %s', channel_ids[int(request_id)], exception)
+        else:
+            responses[int(request_id)] = response
+
+    for i in range(0, len(requests), 50):
+        batch = youtube.new_batch_http_request(callback=callback)
+        for index in range(i, min(i + 50, len(requests))):
+            batch.add(requests[index], request_id=str(index))
+        try:
+            batch.execute()
+        # BatchError, raised when the batch response cannot be parsed, is a subclass of HttpError.
+        except googleapiclient.errors.HttpError as e:
+            logger.warning('Batched request failed, sending the requests one by one: %s', e)
+
+    for index, request in enumerate(requests):
+        if responses[index] is None:
+            try:
+                responses[index] = request.execute()
+            except googleapiclient.errors.HttpError as e:
+                logger.error('Failed to fetch channel %s: %s', channel_ids[index], e)
+    return responses
+
+
+def get_video_list(response, channel_id, last_downloaded=None):
     """
     Returns a list of videos from a YouTube channel.
     Args:
-        channel_id: the channel id of the channel to get the video list from.
+        response: the response of the request built by list_videos_request for the channel's uploads playlist.
+        channel_id: the channel id of the channel the video list is from.
         last_downloaded: if this is not None, it will be used to get the latest videos up to this one.
 
     Returns:
@@ -62,94 +200,121 @@ def get_video_list(channel_id, last_downloaded=None):
 
     """
     if last_downloaded:
-        request = youtube.search().list(
-            part="snippet",
-            channelId=channel_id,
-            maxResults=25,
-            order="date",
-            type="video"
-        )
-        response = request.execute()
         videos = []
-        lastest = response['items'][0]['id']['videoId']
+        lastest = response['items'][0]['snippet']['resourceId']['videoId']
         for video in response['items']:
             new_video = {
-                'id': video['id']['videoId'],
+                'id': video['snippet']['resourceId']['videoId'],
                 'title': video['snippet']['title'],
-                'publishedAt': dateutil.parser.isoparse(video['snippet']['publishedAt']),
+                'publishedAt': parse_datetime(video['snippet']['publishedAt']),
             }
             if new_video['id'] == last_downloaded:
                 break
             else:
                 videos.append(new_video)
 
-        debug_print(f'From channel {channel_id}, fetched new videos: {videos}')
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('From channel %s, fetched new videos: %s', channel_id, pformat(videos))
         return videos, lastest
     else:
-        request = youtube.search().list(
-            part="snippet",
-            channelId=channel_id,
-            maxResults=1,
-            order="date",
-            type="video"
-        )
-        response = request.execute()
-        return response['items'][0]['id']['videoId']
+        return response['items'][0]['snippet']['resourceId']['videoId']
 
 
-# uses youtube_dlp instead of youtube_dl for speed.
-def download_audio(video_id):
-    video_link_prefix = 'https://www.youtube.com/watch?v='
-
-    ydl_opts = {
-        'paths': {'home': './downloads/'},
-        'format': 'm4a/bestaudio/best',
-        'outtmpl': '%(title)s - %(channel)s.%(ext)s'
-        # 'postprocessors': [{  # Extract audio using ffmpeg
-        #     'key': 'FFmpegExtractAudio',
-        #     'preferredcodec': 'm4a',
-        # }]
-    }
-
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        try:
-            error_code = ydl.download(f'{video_link_prefix}{video_id}')
-        except yt_dlp.utils.DownloadError as e:
-            debug_print(f'Error: {e}')
+def parse_datetime(timestamp):
+    """
+    Parses a timestamp returned by the YouTube API, like '2022-07-07T15:32:30Z'.
+    datetime.fromisoformat does not accept the 'Z' suffix before Python 3.11, so it is replaced with the UTC offset.
+    """
+    return datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+
+
+# yt-dlp is bound by the network, so downloading a few videos at a time saturates the bandwidth better.
+# the videos are handed to the workers one at a time, so a long video does not hold up the others. each worker thread
+# keeps its own YoutubeDL instance in a threading.local and reuses it for every video it downloads, since an instance
+# is costly to set up and not safe to share between threads. the instances are closed once all downloads are done.
+def download_videos(video_ids, jobs):
+    local = threading.local()
+
+    with ExitStack() as stack:
+        def download(video_id):
+            if not hasattr(local, 'ydl'):
+                # YoutubeDL writes into the options it is given, so each instance gets a copy.
+                local.ydl = stack.enter_context(yt_dlp.YoutubeDL(dict(ydl_opts)))
+            download_audio(local.ydl, video_id)
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            list(executor.map(download, video_ids))
 
 
-def debug_print(message):
-    if debug:
-        pprint(message)
+# uses youtube_dlp instead of youtube_dl for speed.
+# downloads one video with the given YoutubeDL instance. YoutubeDL.download reports every failure as a DownloadError,
+# so a failed video is skipped without stopping the others.
+def download_audio(ydl, video_id):
+    try:
+        ydl.download([f'{video_link_prefix}{video_id}'])
+    # yt-dlp has already printed the error itself, only say which video it was.
+    except yt_dlp.utils.DownloadError:
+        logger.error('Failed to download %s', video_id)
 
 
 # these functions read and writes the data from and to the file last_downloaded
+# read_dict returns None if the datafile does not exist yet.
 def read_dict():
-    with open('last_downloaded', 'r') as file:
-        return json.load(file)
+    try:
+        with open('last_downloaded', 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
 
 
+# the data is written to a temporary file first and renamed over the datafile, so an interrupted run never leaves a
+# truncated datafile behind.
 def write_dict(data):
-    with open('last_downloaded', 'w') as file:
-        json.dump(data, file)
-    debug_print(f'Wrote to the datafile')
+    with open('last_downloaded.tmp', 'w') as file:
+        file.write(json.dumps(data))
+        # make sure the data is on disk before the rename is.
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace('last_downloaded.tmp', 'last_downloaded')
+    logger.debug('Wrote to the datafile')
 
 
-def init_dict(channels):
+def init_dict(youtube, channels):
     data = []
-    for channel in channels:
-        video_id = get_video_list(channel)
+    playlists = get_uploads_playlists(youtube, channels)
+    missing = [channel for channel in channels if channel not in playlists]
+    if missing:
+        logger.error('Failed to find channels %s, the datafile is not initialized', ', '.join(missing))
+        return
+    requests = [list_videos_request(youtube, playlists[channel], 1) for channel in channels]
+    responses = execute_batch(youtube, channels, requests)
+    if None in responses:
+        logger.error('Failed to fetch some of the channels, the datafile is not initialized')
+        return
+    for channel, response in zip(channels, responses):
+        video_id = get_video_list(response, channel)
         last_downloaded = {
             'channel_id': channel,
+            'playlist_id': playlists[channel],
             'video_id': video_id
         }
         data.append(last_downloaded)
     write_dict(data)
-    debug_print(f'Initialized the datafile: {data}')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Initialized the datafile: %s', pformat(data))
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'{value} is not a positive integer')
+    return number
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Download audio from YouTube channels specified in channel_id.txt.')
     parser.add_argument('-D', '--debug', action='store_true', help='Print debug messages.')
+    parser.add_argument('-j', '--jobs', type=positive_int, default=os.getenv('DOWNLOAD_CONCURRENCY', '4'),
+                        help='Number of videos to download at the same time, defaults to $DOWNLOAD_CONCURRENCY or 4.')
     args = parser.parse_args()
-    main(args.debug)
+    main(args.debug, args.jobs)